@@ -1,74 +1,109 @@
+import functools
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def flatten_json(x, sep="__"):
-    x_out = x.copy()
+    # Most configs are already flat
+    if not any(isinstance(v, (dict, list)) for v in x.values()):
+        return x.copy()
 
-    while True:
-        done = True
+    x_out = {}
+    stack = [("", x)]
 
-        for k, v in x.items():
+    while stack:
+        prefix, v = stack.pop()
 
-            if type(v) is dict:
-                done = False
-                del x_out[k]
+        if isinstance(v, dict):
+            items = [
+                (f"{prefix}{sep}{k}" if prefix else k, v_inner)
+                for k, v_inner in v.items()
+            ]
 
-                for k_inner, v_inner in v.items():
-                    x_out["{}{}{}".format(k, sep, k_inner)] = v_inner
+        elif isinstance(v, list):
+            items = [(f"{prefix}{sep}{k}", v_inner) for k, v_inner in enumerate(v)]
 
-            elif type(v) is list:
-                done = False
-                del x_out[k]
+        else:
+            x_out[prefix] = v
+            continue
 
-                for k_inner, v_inner in enumerate(v):
-                    x_out["{}{}{}".format(k, sep, k_inner)] = v_inner
+        # Reversed so that keys are emitted in their original order
+        stack.extend(reversed(items))
 
-        if done:
-            break
+    return x_out
 
-        x = x_out.copy()
 
-    return x_out
+# json-compatible conversions for numpy types, looked up along the type's MRO
+_NUMPY_CONVERTERS = {
+    np.integer: int,
+    np.floating: float,
+    np.complexfloating: lambda obj: {"real": obj.real, "imag": obj.imag},
+    np.ndarray: np.ndarray.tolist,
+    np.bool_: bool,
+    np.void: lambda obj: None,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy_converter(t):
+    for base in t.__mro__:
+        if base in _NUMPY_CONVERTERS:
+            return _NUMPY_CONVERTERS[base]
+
+    return None
 
 
 class NumpyEncoder(json.JSONEncoder):
     """ Custom encoder for numpy data types """
 
     def default(self, obj):
-        if isinstance(
-            obj,
-            (
-                np.int_,
-                np.intc,
-                np.intp,
-                np.int8,
-                np.int16,
-                np.int32,
-                np.int64,
-                np.uint8,
-                np.uint16,
-                np.uint32,
-                np.uint64,
-            ),
-        ):
-
-            return int(obj)
-
-        if isinstance(obj, (np.float_, np.float16, np.float32, np.float64)):
-            return float(obj)
-
-        if isinstance(obj, (np.complex_, np.complex64, np.complex128)):
-            return {"real": obj.real, "imag": obj.imag}
-
-        if isinstance(obj, (np.ndarray,)):
-            return obj.tolist()
-
-        if isinstance(obj, (np.bool_)):
-            return bool(obj)
-
-        if isinstance(obj, (np.void)):
-            return None
+        convert = _numpy_converter(type(obj))
+
+        if convert is not None:
+            return convert(obj)
 
         return json.JSONEncoder.default(self, obj)
+
+
+def read_json(path):
+    """Read a json file, with orjson if available and the stdlib otherwise"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN and Infinity tokens that json.dump writes
+            pass
+
+    return json.loads(data)
+
+
+def write_json(x, path):
+    """Write x to a json file
+
+    This uses the stdlib rather than orjson, which would write NaN and inf as
+    null and so lose them on reload.
+    """
+    with open(path, "w") as f:
+        json.dump(x, f, cls=NumpyEncoder)
+
+
+def thread_map(f, xs):
+    """Apply f to each element of xs on a thread pool, preserving order
+
+    Used for the per-eid file I/O, which is dominated by syscalls and decoding
+    rather than Python bytecode.
+    """
+    xs = list(xs)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(32, len(xs)))) as ex:
+        return list(ex.map(f, xs))
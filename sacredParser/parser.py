@@ -1,14 +1,103 @@
 import inspect
 import itertools
-import json
 import os
 import pickle
 import re
+import string
 import warnings
+import weakref
+from collections import defaultdict
+from collections.abc import MutableMapping
 
+import numpy as np
 import pandas as pd
 from sacredParser import core
 
+# Translation table mapping every character but [a-z0-9] to "_"
+_COLUMN_CHARS = defaultdict(
+    lambda: "_", {ord(c): c for c in string.ascii_lowercase + string.digits}
+)
+
+# Files written by sacred itself, rather than artifacts
+_SACRED_FILENAMES = frozenset(["config.json", "metrics.json", "run.json", "cout.txt"])
+
+# Weakly keyed, so that cached user functions (and whatever they capture) can
+# still be garbage collected
+_ARGSPECS = weakref.WeakKeyDictionary()
+
+
+def _argspec(f):
+    """Argument spec of f, looking through wrappers such as numba's njit"""
+    try:
+        return _ARGSPECS[f]
+    except (KeyError, TypeError):
+        pass
+
+    spec = inspect.getfullargspec(inspect.unwrap(f))
+
+    try:
+        _ARGSPECS[f] = spec
+    except TypeError:  # Unhashable or not weak-referenceable, so not cached
+        pass
+
+    return spec
+
+
+class _LazyArtifact(MutableMapping):
+    """An artifact's values by eid, each read from file on first access"""
+
+    def __init__(self, parser, filename):
+        self._parser = parser
+        self._filename = filename
+        # The eids with a value, loaded or not, as an ordered set
+        self._eids = dict.fromkeys(parser.eids)
+        self._cache = {}
+
+    def __getitem__(self, eid):
+        if eid not in self._cache:
+            if eid not in self._eids:
+                raise KeyError(eid)
+            self._cache[eid] = self._parser._load_file(eid, self._filename)
+
+        return self._cache[eid]
+
+    def __setitem__(self, eid, value):
+        self._eids[eid] = None
+        self._cache[eid] = value
+
+    def __delitem__(self, eid):
+        del self._eids[eid]
+        self._cache.pop(eid, None)
+
+    def __contains__(self, eid):
+        return eid in self._eids
+
+    def __iter__(self):
+        return iter(self._eids)
+
+    def __len__(self):
+        return len(self._eids)
+
+    def __repr__(self):
+        return "<artifact {} ({}/{} loaded)>".format(
+            self._filename, len(self._cache), len(self)
+        )
+
+    def preload(self, eids=None):
+        """Read the values not yet loaded (for all eids by default) in parallel"""
+        if eids is not None:
+            eids = set(eids)
+
+        eids = [
+            eid
+            for eid in self._eids
+            if ((eids is None) or (eid in eids)) and eid not in self._cache
+        ]
+        values = core.thread_map(
+            lambda eid: self._parser._load_file(eid, self._filename), eids
+        )
+        self._cache.update(zip(eids, values))
+
 
 class FileStorageParser:
     """Parser for the sacred FileStorageObserver"""
@@ -16,6 +105,7 @@ class FileStorageParser:
     def __init__(self, basedir, processed_dirname=None):
         self.basedir = basedir
         self.processed_dirname = processed_dirname
+        self._eid_dirs = {}
         self.eids = [
             int(f)
             for f in os.listdir(self.basedir)
@@ -31,44 +121,59 @@ class FileStorageParser:
         self.artifacts = self._artifacts()
 
     def _config_df(self):
-        cfgs = [None] * len(self.eids)
+        cfgs = core.thread_map(
+            core.read_json,
+            (os.path.join(self._eid_dir(eid), "config.json") for eid in self.eids),
+        )
 
-        for i, eid in enumerate(self.eids):
-            with open(os.path.join(self._eid_dir(eid), "config.json")) as f:
-                cfg = json.load(f)
+        # Build the frame column by column: missing fields are left as NaN
+        columns = {}
 
+        for i, cfg in enumerate(cfgs):
             if self.processed_dirname is None:
                 assert "eid" not in cfg, '"eid" should not be a config field'
 
-            cfg = core.flatten_json(cfg)
-            cfg["eid"] = eid
-
-            cfgs[i] = cfg
+            for k, v in core.flatten_json(cfg).items():
+                columns.setdefault(k, [np.nan] * len(cfgs))[i] = v
 
-        cfg_df = pd.DataFrame(cfgs).set_index("eid")
-        cfg_df.columns = cfg_df.columns.str.lower().str.replace("[^a-z0-9]", "_")
+        columns.pop("eid", None)
+        cfg_df = pd.DataFrame(columns, index=pd.Index(self.eids, name="eid"))
+        cfg_df.columns = [c.lower().translate(_COLUMN_CHARS) for c in cfg_df.columns]
 
         return cfg_df
 
     def _artifacts(self):
-        artifact_filenames = set(
-            f
-            for eid in self.eids
-            for f in os.listdir(self._eid_dir(eid))
-            if os.path.isfile(os.path.join(self._eid_dir(eid), f))
-            and (f not in ["config.json", "metrics.json", "run.json", "cout.txt"])
-        )
+        artifact_filenames = set()
+        for eid in self.eids:
+            with os.scandir(self._eid_dir(eid)) as entries:
+                artifact_filenames.update(
+                    entry.name
+                    for entry in entries
+                    if entry.is_file() and entry.name not in _SACRED_FILENAMES
+                )
+
+        # Artifacts are only read once they are used
         return {
-            os.path.splitext(f)[0]: {eid: self._load_file(eid, f) for eid in self.eids}
-            for f in artifact_filenames
+            os.path.splitext(f)[0]: _LazyArtifact(self, f) for f in artifact_filenames
         }
 
     def _argnames(self):
-        return (
-            ["eid"] + [str(name) for name in self.cfg_df.columns] + list(self.artifacts)
+        """The names that can be passed to user functions, as a set
+
+        Built afresh on each call, as cfg_df and artifacts may be edited directly
+        """
+        return frozenset(
+            ["eid", *(str(name) for name in self.cfg_df.columns), *self.artifacts]
         )
 
     def _eid_dir(self, eid, dirname=None):
+        key = (eid, dirname)
+        if key not in self._eid_dirs:
+            self._eid_dirs[key] = self._make_eid_dir(eid, dirname=dirname)
+
+        return self._eid_dirs[key]
+
+    def _make_eid_dir(self, eid, dirname=None):
         root = os.path.join(self.basedir, str(eid))
 
         if dirname is not None:
@@ -87,32 +192,71 @@ class FileStorageParser:
             return None
         if ext == ".feather":
             return pd.read_feather(path)
+        if ext == ".parquet":
+            return pd.read_parquet(path)
         if ext == ".json":
-            with open(path) as f:
-                return json.load(f)
+            return core.read_json(path)
         if ext in [".pickle", ".pkl"]:
-            with open(path, "rb") as f:
+            # pickle reads in many small chunks, so use a larger buffer
+            with open(path, "rb", buffering=1 << 16) as f:
                 return pickle.load(f)
 
         raise NotImplementedError(ext)
 
     def _kwargs(self, argnames, eid):
-        return {
-            arg: eid
-            if arg == "eid"
-            else self.cfg_df[arg][eid]
-            if arg in self.cfg_df.columns
-            else self.artifacts[arg][eid]
-            if arg in self.artifacts
-            else None
+        return next(self._kwargs_along_eids(argnames, eids=[eid]))
+
+    def _kwargs_along_eids(self, argnames, eids=None):
+        """Yield the kwargs for each eid (all by default), resolving argnames once"""
+        eids = self.eids if eids is None else eids
+        available = self._argnames()
+        argnames = [arg for arg in argnames if arg in available]
+        cfg_cols = [
+            arg for arg in argnames if arg != "eid" and arg in self.cfg_df.columns
+        ]
+        artifacts = {
+            arg: self.artifacts[arg]
             for arg in argnames
-            if arg in self._argnames()
+            if arg != "eid" and arg not in cfg_cols
         }
+        if len(eids) > 1:
+            for artifact in artifacts.values():
+                if isinstance(artifact, _LazyArtifact):
+                    artifact.preload(eids)
+
+        # Iterating rows of the selected columns avoids a pandas lookup per cell.
+        # Rows are selected by eid, as cfg_df may have been reordered
+        rows = (
+            self.cfg_df.loc[eids, cfg_cols].itertuples(index=False, name=None)
+            if cfg_cols
+            else itertools.repeat(())
+        )
+
+        for eid, row in zip(eids, rows):
+            kwargs = dict(zip(cfg_cols, row))
+            for arg, artifact in artifacts.items():
+                kwargs[arg] = artifact[eid]
+            if "eid" in argnames:
+                kwargs["eid"] = eid
+
+            yield kwargs
+
+    def _kwargs_vectorized(self, argnames):
+        """The kwargs for all eids at once, as arrays of config columns"""
+        kwargs = {}
+
+        for arg in argnames:
+            if arg == "eid":
+                kwargs[arg] = self.cfg_df.index.to_numpy()
+            elif arg in self.cfg_df.columns:
+                kwargs[arg] = self.cfg_df[arg].to_numpy()
+            elif arg in self.artifacts:
+                raise Exception(f"Artifact {arg} cannot be used when vectorized")
+
+        return kwargs
 
     def eid_match(self, **kwargs):
-        ix = True
-        for k, v in kwargs.items():
-            ix = ix & (self.cfg_df[k] == v)
+        ix = (self.cfg_df[list(kwargs)] == pd.Series(kwargs, dtype=object)).all(axis=1)
 
         return self.cfg_df.index[ix]
 
@@ -123,12 +267,19 @@ class FileStorageParser:
         if name in self.cfg_df.columns:
             raise Exception(f"Name {name} already a config hyperparameter name")
 
-        argnames = inspect.getfullargspec(f)[0]
+        argnames = _argspec(f).args
         self.artifacts[name] = {
-            eid: f(**self._kwargs(argnames, eid)) for eid in self.eids
+            eid: f(**kwargs)
+            for eid, kwargs in zip(self.eids, self._kwargs_along_eids(argnames))
         }
 
-    def add_cfg_col(self, name, f):
+    def add_cfg_col(self, name, f, vectorized=False):
+        """Add a config column, computed by f for each eid
+
+        If vectorized, f is instead called once with whole config columns as
+        numpy arrays and should return an array (or scalar) for all eids, e.g.
+        a numpy expression or a numba.vectorize function.
+        """
         if name == "eid":
             raise Exception('Cannot use name "eid"')
 
@@ -138,31 +289,55 @@ class FileStorageParser:
         if name in self.cfg_df.columns:
             warnings.warn("You are overwriting a config column")
 
-        argnames = inspect.getfullargspec(f)[0]
-        self.cfg_df[name] = [f(**self._kwargs(argnames, eid)) for eid in self.eids]
+        argnames = _argspec(f).args
+        if vectorized:
+            kwargs = self._kwargs_vectorized(argnames)
+            # Positionally when possible, as ufuncs take no keyword arguments
+            if list(kwargs) == argnames:
+                self.cfg_df[name] = f(*kwargs.values())
+            else:
+                self.cfg_df[name] = f(**kwargs)
+        else:
+            # Aligned on eid, as the values are computed in self.eids order
+            self.cfg_df[name] = pd.Series(
+                [f(**kwargs) for kwargs in self._kwargs_along_eids(argnames)],
+                index=self.eids,
+            )
 
     def do_for_eid(self, eid, f, **kwargs):
         """Apply the function f to a single eid"""
-        argnames = [arg for arg in inspect.getfullargspec(f)[0] if arg not in kwargs]
+        argnames = [arg for arg in _argspec(f).args if arg not in kwargs]
         return f(**self._kwargs(argnames, eid), **kwargs)
 
     def do_along_eids(self, f, **kwargs):
         """Apply the function f to each eid"""
-        argnames = [arg for arg in inspect.getfullargspec(f)[0] if arg not in kwargs]
-        return [f(**self._kwargs(argnames, eid), **kwargs) for eid in self.eids]
+        argnames = [arg for arg in _argspec(f).args if arg not in kwargs]
+        return [
+            f(**eid_kwargs, **kwargs)
+            for eid_kwargs in self._kwargs_along_eids(argnames)
+        ]
 
     def unnested_artifact(self, artifact_name, eids=None):
+        if eids is not None:
+            eids = set(eids)
+
+        artifact = self.artifacts[artifact_name]
+        if isinstance(artifact, _LazyArtifact):
+            artifact.preload(eids)
+
+        # Any existing eid column is replaced by the eid key
+        artifacts = {
+            eid: artifact[eid].drop(columns="eid")
+            if "eid" in artifact[eid].columns
+            else artifact[eid]
+            for eid in self.eids
+            if ((eids is None) or (eid in eids)) and artifact[eid] is not None
+        }
         df = (
-            pd.concat(
-                [
-                    artifact.assign(eid=eid)
-                    for eid, artifact in self.artifacts[artifact_name].items()
-                    if (eids is None) or (eid in eids)
-                ]
-            )
-            .set_index("eid")
-            .join(self.cfg_df)
-        ).reset_index()
+            pd.concat(list(artifacts.values()), keys=list(artifacts), names=["eid"])
+            .reset_index(level=0)
+            .join(self.cfg_df, on="eid")
+        ).reset_index(drop=True)
         return df
 
     def _save_artifact(self, artifact_name, eid, dirname):
@@ -174,31 +349,31 @@ class FileStorageParser:
 
         if type(x) is pd.DataFrame:
             path = os.path.join(root, "{}.pkl".format(artifact_name))
-            return x.to_pickle(path)
+            return x.to_pickle(path, protocol=5)
 
         if type(x) is list:
             path = os.path.join(root, "{}.json".format(artifact_name))
-            with open(path, "w") as f:
-                out = json.dump(x, f, cls=core.NumpyEncoder)
-            return out
+            return core.write_json(x, path)
 
-        raise NotImplementedError(type(x))
+        path = os.path.join(root, "{}.pkl".format(artifact_name))
+        with open(path, "wb") as f:
+            return pickle.dump(x, f, protocol=5)
 
     def _save_config(self, eid, dirname):
-        root = self._eid_dir(eid, dirname=dirname)
-        if not os.path.isdir(root):
-            os.mkdir(root)
+        path = os.path.join(self._eid_dir(eid, dirname=dirname), "config.json")
+
+        core.write_json(self.cfg_df.loc[eid].to_dict(), path)
 
-        path = os.path.join(root, "config.json")
+    def _save_eid(self, eid, dirname):
+        self._save_config(eid, dirname=dirname)
 
-        with open(path, "w") as f:
-            json.dump(dict(self.cfg_df.loc[eid]), f, cls=core.NumpyEncoder)
+        for artifact_name in self.artifacts:
+            self._save_artifact(artifact_name, eid, dirname=dirname)
 
     def save(self, dirname):
         """Save a (likely processed) experiment: config and artifacts"""
 
         for eid in self.eids:
-            self._save_config(eid, dirname=dirname)
+            os.makedirs(self._eid_dir(eid, dirname=dirname), exist_ok=True)
 
-            for artifact_name in self.artifacts:
-                self._save_artifact(artifact_name, eid, dirname=dirname)
+        core.thread_map(lambda eid: self._save_eid(eid, dirname=dirname), self.eids)
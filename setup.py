@@ -6,5 +6,6 @@ setup(
     author="henryjon",
     url="https://github.com/henryjon/sacred-parser",
     install_requires=["numpy", "pandas"],
+    extras_require={"fast": ["orjson"]},
     version="0.0.1",
 )